@@ -4,12 +4,16 @@ import json
 import logging
 from pathlib import Path
 from huggingface_hub import hf_hub_download, list_models, HfApi
-from llama_cpp import Llama
+from llama_cpp import Llama, StoppingCriteriaList
 import threading
+import hashlib
 import time
 from typing import Optional, List, Dict
 from config import *
 from datetime import datetime
+from contextlib import contextmanager
+from request_capture import RequestCapture
+from profiling import RequestProfiler
 
 class ModelManager:
     def __init__(self):
@@ -17,6 +21,12 @@ class ModelManager:
         self.models_dir.mkdir(exist_ok=True)
         self.config_file = DIRECTORY_CONFIG["config_file"]
         self.current_model: Optional[Llama] = None
+        # llama.cpp模型不支持并发调用，前台对话和后台摘要共用一把锁
+        self.generate_lock = threading.Lock()
+        self.last_activity = time.time()
+        # 等待生成的前台请求数，后台摘要发现有前台请求时提前停止
+        self.foreground_waiting = 0
+        self.waiting_lock = threading.Lock()
         self.model_info = self.load_model_config()
         self.setup_logging()
         
@@ -158,15 +168,18 @@ class ModelManager:
             file_size = os.path.getsize(model_path)
             self.logger.info(f"准备加载模型: {model_path} (大小: {file_size/(1024**3):.2f} GB)")
             
-            if self.current_model:
-                del self.current_model
+            # 等待正在进行的生成结束后再释放旧模型，加载期间属性始终存在
+            with self.generate_lock:
+                self.current_model = None
             
-            self.current_model = Llama(
+            model = Llama(
                 model_path=model_path,
                 n_ctx=MODEL_CONFIG["n_ctx"],
                 n_threads=MODEL_CONFIG["n_threads"],
                 verbose=MODEL_CONFIG["verbose"]
             )
+            with self.generate_lock:
+                self.current_model = model
             self.logger.info(f"模型加载成功: {model_path}")
             return True
         except Exception as e:
@@ -176,32 +189,244 @@ class ModelManager:
             self.logger.error(f"详细错误信息: {error_details}")
             return False
     
-    def generate_response(self, prompt: str, max_tokens: int = None) -> str:
-        """生成回复"""
+    def count_tokens(self, text: str) -> int:
+        """统计文本的token数"""
+        model = self.current_model
+        if not model:
+            return 0
+        return len(model.tokenize(text.encode('utf-8'), add_bos=False))
+    
+    @contextmanager
+    def model_turn(self, background: bool = False):
+        """获取模型使用权，前台请求等待期间计入 foreground_waiting"""
+        if background:
+            with self.generate_lock:
+                yield
+            return
+        
+        with self.waiting_lock:
+            self.foreground_waiting += 1
+        try:
+            self.generate_lock.acquire()
+        finally:
+            with self.waiting_lock:
+                self.foreground_waiting -= 1
+        try:
+            yield
+        finally:
+            self.generate_lock.release()
+    
+    def generate_response(self, prompt: str, max_tokens: int = None, stop: List[str] = None,
+                          background: bool = False) -> Optional[str]:
+        """生成回复
+        
+        后台生成不返回面向用户的提示文本：被前台请求打断或模型未加载时返回None，出错时抛出异常
+        """
         if not self.current_model:
-            return "请先选择并加载模型"
+            return None if background else "请先选择并加载模型"
         
         if max_tokens is None:
             max_tokens = MODEL_CONFIG["max_tokens"]
+        if stop is None:
+            stop = ["\n用户:", "\n\n", "用户:", "助手:", "\n助手:"]
+        
+        # 后台生成在每个token后检查是否有前台请求在等待
+        preempted = []
+        def preempt(input_ids, logits) -> bool:
+            if self.foreground_waiting > 0:
+                preempted.append(True)
+                return True
+            return False
+        extra = {"stopping_criteria": StoppingCriteriaList([preempt])} if background else {}
         
         try:
-            response = self.current_model(
-                prompt,
-                max_tokens=max_tokens,
-                temperature=MODEL_CONFIG["temperature"],
-                top_p=MODEL_CONFIG["top_p"],
-                repeat_penalty=MODEL_CONFIG["repeat_penalty"],
-                echo=False,
-                stop=["\n用户:", "\n\n", "用户:", "助手:", "\n助手:"]
-            )
+            with self.model_turn(background):
+                # 等锁期间模型可能正在重新加载
+                if not self.current_model:
+                    return None if background else "请先选择并加载模型"
+                try:
+                    response = self.current_model(
+                        prompt,
+                        max_tokens=max_tokens,
+                        temperature=MODEL_CONFIG["temperature"],
+                        top_p=MODEL_CONFIG["top_p"],
+                        repeat_penalty=MODEL_CONFIG["repeat_penalty"],
+                        echo=False,
+                        stop=stop,
+                        **extra
+                    )
+                finally:
+                    self.last_activity = time.time()
+            if preempted:
+                return None
             return response['choices'][0]['text'].strip()
         except Exception as e:
             self.logger.error(f"生成回复时出错: {e}")
+            if background:
+                raise
             return f"生成回复时出错: {str(e)}"
+    
+    def is_idle(self, idle_seconds: float) -> bool:
+        """模型是否处于空闲状态"""
+        return not self.generate_lock.locked() and time.time() - self.last_activity >= idle_seconds
+
+class ConversationSummarizer:
+    """在模型空闲时将较早的对话压缩为滚动摘要，按会话缓存"""
+    
+    def __init__(self, manager: ModelManager):
+        self.manager = manager
+        self.sessions: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+    
+    @staticmethod
+    def digest(messages: List[Dict]) -> str:
+        """计算消息列表的摘要指纹，用于判断缓存是否仍然对应当前历史"""
+        sha = hashlib.sha1()
+        for msg in messages:
+            sha.update(f"{msg['role']}\x00{msg['content']}\x00".encode('utf-8'))
+        return sha.hexdigest()
+    
+    def build_context(self, session_id: str, history: List[Dict]) -> tuple:
+        """返回 (摘要, 需要原样放入提示的消息, 本轮节省的token数)"""
+        split = max(0, len(history) - SUMMARY_CONFIG["keep_recent"])
+        split -= split % 2
+        older = history[:split]
+        
+        with self.lock:
+            state = self.sessions.get(session_id)
+            # 历史被清空或修改后，缓存的摘要不再有效
+            if state and (state["covered"] > len(older) or
+                          self.digest(older[:state["covered"]]) != state["digest"]):
+                state = None
+            if state is None:
+                state = {"summary": "", "summary_tokens": 0, "covered": 0,
+                         "digest": self.digest([]), "message_tokens": []}
+            # 每次访问都移到末尾，超出上限时淘汰最久未使用的会话
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = state
+            while len(self.sessions) > SUMMARY_CONFIG["max_sessions"]:
+                self.sessions.pop(next(iter(self.sessions)))
+            # 记录待摘要的历史，由后台线程在空闲时处理
+            state["pending"] = list(older)
+            summary, covered = state["summary"], state["covered"]
+            
+            # 每条消息只统计一次token数，用于计算节省量
+            message_tokens = state["message_tokens"]
+            del message_tokens[len(history):]
+            for msg in history[len(message_tokens):]:
+                message_tokens.append(self.manager.count_tokens(format_message(msg)))
+            message_tokens = list(message_tokens)
+            summary_tokens = state["summary_tokens"]
+        
+        # 尚未摘要的较早轮次原样保留，避免丢失信息；但总条数有上限，
+        # 摘要跟不上时丢弃最早的轮次，保证提示长度不超过原来的截断策略
+        verbatim = older[covered:] + history[split:]
+        limit = SUMMARY_CONFIG["max_verbatim_messages"]
+        if len(verbatim) > limit:
+            dropped = len(verbatim) - limit
+            dropped += dropped % 2
+            verbatim = verbatim[dropped:]
+            dropped_tokens = sum(message_tokens[covered:covered + dropped])
+            self.manager.logger.warning(
+                f"会话 {session_id} 尚未摘要的消息过多，本轮提示丢弃最早的 {dropped} 条消息（{dropped_tokens} tokens）"
+            )
+        
+        # 只有被摘要覆盖的消息算作节省，被丢弃的消息不计入
+        saved_tokens = sum(message_tokens[:covered]) - summary_tokens
+        return summary, verbatim, saved_tokens
+    
+    def run(self):
+        """后台线程：模型空闲时增量更新摘要"""
+        while True:
+            time.sleep(SUMMARY_CONFIG["check_interval"])
+            # 任何异常都只记录日志，不能让后台线程退出
+            try:
+                if not self.manager.current_model or not self.manager.is_idle(SUMMARY_CONFIG["idle_seconds"]):
+                    continue
+                
+                now = time.time()
+                with self.lock:
+                    work = next(((sid, state) for sid, state in self.sessions.items()
+                                 if len(state.get("pending", [])) > state["covered"] and
+                                 state.get("retry_at", 0) <= now), None)
+                if work is None:
+                    continue
+                
+                self.update_summary(*work)
+            except Exception as e:
+                self.manager.logger.error(f"更新对话摘要失败: {e}")
+    
+    def update_summary(self, session_id: str, state: Dict):
+        """将下一批未摘要的消息合并到已有摘要中"""
+        with self.lock:
+            pending = state["pending"]
+            covered = state["covered"]
+            summary = state["summary"]
+        batch = pending[covered:covered + SUMMARY_CONFIG["update_batch"]]
+        
+        prompt = "请将下面的新对话内容合并到已有摘要中，保留人名、数字、偏好等重要事实，输出简短的摘要。\n\n"
+        if summary:
+            prompt += f"已有摘要: {summary}\n\n"
+        prompt += "新对话:\n"
+        for msg in batch:
+            role = "用户" if msg["role"] == "user" else "助手"
+            prompt += f"{role}: {msg['content']}\n"
+        prompt += "\n更新后的摘要: "
+        
+        # 摘要内容可能分段，不能像对话那样遇到空行就停止
+        try:
+            new_summary = self.manager.generate_response(
+                prompt,
+                max_tokens=SUMMARY_CONFIG["max_summary_tokens"],
+                stop=["\n用户:", "\n助手:", "\n新对话:"],
+                background=True
+            )
+        except Exception:
+            # 生成出错按空结果处理，计入失败次数
+            new_summary = ""
+        if new_summary is None:
+            # 被前台请求打断或模型正在重新加载，等下次空闲时重试，不计入失败次数
+            return
+        
+        with self.lock:
+            # 摘要期间会话已被重置则丢弃结果
+            if self.sessions.get(session_id) is not state or state["covered"] != covered:
+                return
+            
+            if not new_summary:
+                state["failures"] = state.get("failures", 0) + 1
+                if state["failures"] < SUMMARY_CONFIG["max_retries"]:
+                    delay = SUMMARY_CONFIG["idle_seconds"] * 2 ** state["failures"]
+                    state["retry_at"] = time.time() + delay
+                    self.manager.logger.warning(f"会话 {session_id} 摘要生成失败，{delay:.1f} 秒后重试")
+                    return
+                # 多次失败后跳过这一批，保留原有摘要
+                self.manager.logger.warning(f"会话 {session_id} 摘要连续失败 {state['failures']} 次，跳过 {len(batch)} 条消息")
+                new_summary = summary
+            
+            if new_summary != summary:
+                state["summary_tokens"] = self.manager.count_tokens(format_summary(new_summary))
+            state["failures"] = 0
+            state["retry_at"] = 0
+            state["summary"] = new_summary
+            state["covered"] = covered + len(batch)
+            state["digest"] = self.digest(pending[:state["covered"]])
+        self.manager.logger.info(f"会话 {session_id} 摘要已更新，覆盖 {state['covered']} 条消息")
 
 # 全局模型管理器
 model_manager = ModelManager()
 
+# 对话摘要器（按配置启用）
+conversation_summarizer = ConversationSummarizer(model_manager) if SUMMARY_CONFIG["enabled"] else None
+
+# 请求形状采集器（按配置启用）
+request_capture = RequestCapture() if CAPTURE_CONFIG["enabled"] else None
+
+# 请求性能分析器（按配置、请求头或采样率启用）
+request_profiler = RequestProfiler()
+
 def get_available_models():
     """获取可用模型列表"""
     return model_manager.get_small_models_from_hf()
@@ -233,29 +458,77 @@ def download_and_load_model(model_id: str, progress=gr.Progress()):
     except Exception as e:
         return f"❌ 错误: {str(e)}", gr.update(interactive=False)
 
-def chat_response(message, history):
+def chat_response(message, history, request: gr.Request = None):
     """聊天回复函数"""
-    if not model_manager.current_model:
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": "请先选择并加载模型"})
-        return history
-    
-    # 限制历史长度，只保留最近的6轮对话（12条消息）
-    if len(history) > 12:
-        history = history[-12:]
-    
+    if request_profiler.should_profile(request):
+        with request_profiler.profile("chat"):
+            return _chat_response(message, history, request)
+    return _chat_response(message, history, request)
+
+def format_message(msg):
+    """格式化单条历史消息"""
+    if msg["role"] == "user":
+        return f"用户: {msg['content']}\n"
+    elif msg["role"] == "assistant":
+        return f"助手: {msg['content']}\n"
+    return ""
+
+def format_summary(summary):
+    """格式化对话摘要"""
+    return f"之前对话的摘要: {summary}\n\n"
+
+def build_prompt(message, history, summary=""):
+    """构建对话提示"""
     # 构建对话历史，使用更自然的格式
     conversation = "你是一个友好、有帮助的AI助手。请根据对话历史，自然地回复用户的问题。\n\n"
     
+    # 添加较早对话的摘要
+    if summary:
+        conversation += format_summary(summary)
+    
     # 添加历史对话
     for msg in history:
-        if msg["role"] == "user":
-            conversation += f"用户: {msg['content']}\n"
-        elif msg["role"] == "assistant":
-            conversation += f"助手: {msg['content']}\n"
+        conversation += format_message(msg)
     
     # 添加当前用户消息
     conversation += f"用户: {message}\n助手: "
+    return conversation
+
+def _chat_response(message, history, request=None):
+    """生成聊天回复"""
+    if not model_manager.current_model:
+        history.append({"role": "user", "content": message})
+        history.append({"role": "assistant", "content": "请先选择并加载模型"})
+        return history
+    
+    # 记录截断或摘要之前的真实历史深度
+    history_depth = len(history)
+    prompt_tokens = None
+    
+    if conversation_summarizer:
+        # 较早的轮次由滚动摘要替代，完整历史仍保留在界面中
+        session_id = getattr(request, "session_hash", None) or "default"
+        summary, prompt_history, saved_tokens = conversation_summarizer.build_context(session_id, history)
+        conversation = build_prompt(message, prompt_history, summary)
+        
+        prompt_tokens = model_manager.count_tokens(conversation)
+        model_manager.logger.info(f"摘要模式: 本轮提示 {prompt_tokens} tokens，节省 {saved_tokens} tokens")
+    else:
+        # 限制历史长度，只保留最近的6轮对话（12条消息）
+        if len(history) > 12:
+            history = history[-12:]
+        prompt_history = history
+        conversation = build_prompt(message, prompt_history)
+    
+    if request_capture:
+        if prompt_tokens is None:
+            prompt_tokens = model_manager.count_tokens(conversation)
+        request_capture.record(
+            prompt_tokens=prompt_tokens,
+            message_tokens=model_manager.count_tokens(message),
+            history_depth=history_depth,
+            max_tokens=256
+        )
     
     # 生成回复
     response = model_manager.generate_response(conversation, max_tokens=256)
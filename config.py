@@ -64,4 +64,60 @@ DIRECTORY_CONFIG = {
     "config_file": "model_config.json",
     "logs_dir": "logs",
     "cache_dir": "cache"
-}
\ No newline at end of file
+}
+
+# 请求采集配置（仅记录请求形状，不记录对话内容）
+CAPTURE_CONFIG = {
+    "enabled": False,
+    "capture_file": "logs/request_capture.jsonl",
+    "max_records": 100000
+}
+
+# 负载回放配置
+LOADTEST_CONFIG = {
+    "sessions": 4,
+    "turns_per_session": 5,
+    "concurrency_limit": 1,
+    "stub_prompt_ms_per_token": 0.5,
+    "stub_gen_ms_per_token": 20.0,
+    "synthetic": {
+        "prompt_tokens_mean": 40,
+        "prompt_tokens_max": 400,
+        "max_tokens": 256,
+        "mean_interarrival": 2.0
+    }
+}
+
+# 请求性能分析配置
+PROFILE_CONFIG = {
+    "enabled": False,
+    "sample_rate": 0.0,
+    "header": "x-localai-profile",
+    "output_dir": "logs/profiles",
+    "sample_interval_ms": 1,
+    "traceback_depth": 25,
+    "top_functions": 40,
+    "top_allocations": 30,
+    "max_reports": 20,
+    "max_total_mb": 200
+}
+
+# 模型校验配置
+VERIFY_CONFIG = {
+    "workers": 4,
+    "chunk_mb": 64,
+    "cache_file": "cache/verify_cache.json"
+}
+
+# 对话摘要配置（长对话中将较早的轮次压缩为滚动摘要）
+SUMMARY_CONFIG = {
+    "enabled": False,
+    "keep_recent": 6,
+    "max_verbatim_messages": 12,
+    "update_batch": 6,
+    "idle_seconds": 3.0,
+    "check_interval": 0.5,
+    "max_summary_tokens": 128,
+    "max_retries": 3,
+    "max_sessions": 256
+}
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LocalAI 负载回放工具
+回放 request_capture.py 采集的请求形状或合成分布，模拟多个并发Gradio会话
+"""
+
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from types import SimpleNamespace
+from typing import Dict, List
+from config import LOADTEST_CONFIG, PROFILE_CONFIG
+
+# 构造合成消息时使用的填充文本
+FILLER_TEXT = "今天天气很好我们一起去公园散步吧"
+
+# chat_response 放入提示的历史消息上限（截断窗口或摘要模式的原文上限）
+PROMPT_HISTORY_LIMIT = 12
+
+
+class StubModel:
+    """确定性的桩模型，按token数模拟提示处理和生成耗时"""
+
+    def __init__(self, prompt_ms_per_token: float = None, gen_ms_per_token: float = None):
+        if prompt_ms_per_token is None:
+            prompt_ms_per_token = LOADTEST_CONFIG["stub_prompt_ms_per_token"]
+        if gen_ms_per_token is None:
+            gen_ms_per_token = LOADTEST_CONFIG["stub_gen_ms_per_token"]
+        self.prompt_ms_per_token = prompt_ms_per_token
+        self.gen_ms_per_token = gen_ms_per_token
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        """每个字符计为一个token"""
+        tokens = [ord(c) for c in text.decode('utf-8', errors='ignore')]
+        return [1] + tokens if add_bos else tokens
+
+    def __call__(self, prompt: str, max_tokens: int = 16, **kwargs) -> Dict:
+        prompt_tokens = len(self.tokenize(prompt.encode('utf-8')))
+        time.sleep((prompt_tokens * self.prompt_ms_per_token + max_tokens * self.gen_ms_per_token) / 1000)
+        text = (FILLER_TEXT * (max_tokens // len(FILLER_TEXT) + 1))[:max_tokens]
+        return {"choices": [{"text": text}]}
+
+
+def load_capture(capture_file: str) -> List[Dict]:
+    """读取采集文件"""
+    requests = []
+    with open(capture_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                requests.append(json.loads(line))
+    return requests
+
+
+def synthetic_requests(count: int, seed: int = 0) -> List[Dict]:
+    """按配置的分布生成合成请求"""
+    synthetic = LOADTEST_CONFIG["synthetic"]
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        message_tokens = min(
+            int(rng.expovariate(1 / synthetic["prompt_tokens_mean"])) + 1,
+            synthetic["prompt_tokens_max"]
+        )
+        requests.append({
+            "dt": round(rng.expovariate(1 / synthetic["mean_interarrival"]), 3),
+            "mt": message_tokens,
+            "hd": 0,
+            "mx": synthetic["max_tokens"]
+        })
+    return requests
+
+
+def make_text(tokens: int) -> str:
+    """生成指定长度的填充文本"""
+    return (FILLER_TEXT * (tokens // len(FILLER_TEXT) + 1))[:max(tokens, 1)]
+
+
+def filler_history(app, message: str, history: List[Dict], count: int, prompt_tokens: int = None) -> List[Dict]:
+    """生成填充历史消息，有采集的提示token数时使构建出的提示长度接近该值
+
+    采集的历史深度是截断前的完整深度，而提示中最多只包含最近的
+    PROMPT_HISTORY_LIMIT 条消息，因此按进入提示的消息数分配token。
+    """
+    user_chars, assistant_chars = 8, 16
+    if prompt_tokens:
+        count_tokens = app.model_manager.count_tokens
+        sample = make_text(len(FILLER_TEXT) * 4)
+        tokens_per_char = count_tokens(sample) / len(sample) or 1.0
+        base = count_tokens(app.build_prompt(message, history))
+        line_overhead = count_tokens("用户: \n")
+        in_prompt = min(len(history) + count, PROMPT_HISTORY_LIMIT) - min(len(history), PROMPT_HISTORY_LIMIT)
+        per_message = (prompt_tokens - base) / max(in_prompt, 1) - line_overhead
+        user_chars = assistant_chars = max(1, round(per_message / tokens_per_char))
+
+    messages = []
+    for i in range(count):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": make_text(user_chars)})
+        else:
+            messages.append({"role": "assistant", "content": make_text(assistant_chars)})
+    return messages
+
+
+class TimedLock:
+    """记录每个线程等待锁的时间，用于把等待模型的时间计入排队"""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.local = threading.local()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        begin = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.local.wait = getattr(self.local, "wait", 0.0) + time.perf_counter() - begin
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def take_wait(self) -> float:
+        """返回并清零当前线程累计的等待时间"""
+        wait = getattr(self.local, "wait", 0.0)
+        self.local.wait = 0.0
+        return wait
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def replay(requests: List[Dict], sessions: int, concurrency_limit: int, time_scale: float = 1.0,
+           profile: bool = False) -> Dict:
+    """以多个并发会话回放请求，返回统计结果"""
+    import app
+
+    # Gradio队列默认每个事件只允许一个并发，用信号量模拟
+    slots = threading.Semaphore(concurrency_limit)
+    results = []
+    results_lock = threading.Lock()
+    # 并发上限大于1时请求会在模型锁上等待，这部分也属于排队
+    model_lock = TimedLock(app.model_manager.generate_lock)
+    app.model_manager.generate_lock = model_lock
+
+    # 按到达间隔计算绝对到达时间，并轮流分配给各个会话
+    arrivals = []
+    offset = 0.0
+    for req in requests:
+        offset += req.get("dt", 0.0) * time_scale
+        arrivals.append(offset)
+    assignments = [[] for _ in range(sessions)]
+    for i, req in enumerate(requests):
+        assignments[i % sessions].append((arrivals[i], req))
+
+    start = time.perf_counter()
+
+    def run_session(session_index: int):
+        history = []
+        headers = {PROFILE_CONFIG["header"]: "1"} if profile else {}
+        request = SimpleNamespace(session_hash=f"loadtest-{session_index}", headers=headers)
+        for arrival, req in assignments[session_index]:
+            # 同一会话在上一轮完成前不能再次提交；落后于计划时，
+            # 延迟仍从计划到达时间算起，避免遗漏积压的等待时间
+            scheduled = start + arrival
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            message = make_text(req.get("mt", 1))
+            missing = req.get("hd", 0) - len(history)
+            if missing > 0:
+                history = history + filler_history(app, message, history, missing, req.get("pt"))
+
+            model_lock.take_wait()
+            with slots:
+                started = time.perf_counter()
+                history = app.chat_response(message, history, request)
+            finished = time.perf_counter()
+            queue = started - scheduled + model_lock.take_wait()
+
+            with results_lock:
+                results.append({
+                    "latency": finished - scheduled,
+                    "queue": queue,
+                    "service": finished - scheduled - queue
+                })
+
+    threads = [threading.Thread(target=run_session, args=(i,)) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    app.model_manager.generate_lock = model_lock.lock
+
+    latencies = [r["latency"] for r in results]
+    queues = [r["queue"] for r in results]
+    services = [r["service"] for r in results]
+    return {
+        "requests": len(results),
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed > 0 else 0.0,
+        "latency": {p: percentile(latencies, p) for p in (50, 95, 99)},
+        "queue": {p: percentile(queues, p) for p in (50, 95, 99)},
+        "service_mean": sum(services) / len(services) if services else 0.0
+    }
+
+
+def print_report(stats: Dict):
+    """打印回放统计结果"""
+    print("\n" + "="*60)
+    print("📈 负载回放结果")
+    print("="*60)
+    print(f"请求数量: {stats['requests']}")
+    print(f"总耗时: {stats['elapsed']:.2f} s")
+    print(f"吞吐量: {stats['throughput']:.2f} req/s")
+    print("延迟: " + ", ".join(f"p{p}={v*1000:.1f} ms" for p, v in stats["latency"].items()))
+    print("排队: " + ", ".join(f"p{p}={v*1000:.1f} ms" for p, v in stats["queue"].items()))
+    print(f"平均处理时间: {stats['service_mean']*1000:.1f} ms")
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="LocalAI 负载回放工具")
+    parser.add_argument("--capture", help="采集文件路径，不指定则使用合成分布")
+    parser.add_argument("--model", help="GGUF模型路径，不指定则使用桩模型")
+    parser.add_argument("--sessions", type=int, default=LOADTEST_CONFIG["sessions"], help="并发会话数")
+    parser.add_argument("--turns", type=int, default=LOADTEST_CONFIG["turns_per_session"],
+                        help="合成模式下每个会话的轮数")
+    parser.add_argument("--concurrency-limit", type=int, default=LOADTEST_CONFIG["concurrency_limit"],
+                        help="模拟Gradio队列的并发上限")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="到达间隔缩放系数")
+    parser.add_argument("--profile", action="store_true", help="为回放的请求开启性能分析")
+    parser.add_argument("--seed", type=int, default=0, help="合成分布随机种子")
+    args = parser.parse_args()
+
+    if args.capture:
+        requests = load_capture(args.capture)
+    else:
+        requests = synthetic_requests(args.sessions * args.turns, seed=args.seed)
+
+    import app
+    if args.model:
+        if not app.model_manager.load_model(args.model):
+            print(f"❌ 模型加载失败: {args.model}")
+            return
+    else:
+        app.model_manager.current_model = StubModel()
+
+    print(f"🚀 回放 {len(requests)} 个请求，{args.sessions} 个并发会话")
+    stats = replay(requests, args.sessions, args.concurrency_limit, args.time_scale, args.profile)
+    print_report(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,164 @@
 # -*- coding: utf-8 -*-
 """
 LocalAI 模型管理工具
-用于管理已下载的模型，查看模型信息，清理缓存等
+用于管理已下载的模型，查看模型信息，清理缓存，校验模型完整性等
 """
 
 import os
 import json
+import mmap
 import shutil
+import struct
+import hashlib
 from pathlib import Path
-from typing import Dict, List
-from config import DIRECTORY_CONFIG
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from config import DIRECTORY_CONFIG, VERIFY_CONFIG
+
+# GGUF文件头: 魔数(4字节) + 版本(uint32) + 张量数量(uint64) + 元数据数量(uint64)
+GGUF_MAGIC = b"GGUF"
+GGUF_HEADER = struct.Struct("<4sIQQ")
+GGUF_VERSIONS = (1, 2, 3)
+GGUF_MAX_COUNT = 1 << 20
+GGUF_DEFAULT_ALIGNMENT = 32
+
+# 元数据中定长类型的字节数，8为字符串，9为数组
+GGUF_VALUE_SIZES = {0: 1, 1: 1, 2: 2, 3: 2, 4: 4, 5: 4, 6: 4, 7: 1, 10: 8, 11: 8, 12: 8}
+GGUF_TYPE_STRING = 8
+GGUF_TYPE_ARRAY = 9
+
+# ggml张量类型: (每块元素数, 每块字节数)
+GGML_TYPE_SIZES = {
+    0: (1, 4), 1: (1, 2), 2: (32, 18), 3: (32, 20), 6: (32, 22), 7: (32, 24),
+    8: (32, 34), 9: (32, 36), 10: (256, 84), 11: (256, 110), 12: (256, 144),
+    13: (256, 176), 14: (256, 210), 15: (256, 292), 16: (256, 66), 17: (256, 74),
+    18: (256, 98), 19: (256, 50), 20: (32, 18), 21: (256, 110), 22: (256, 82),
+    23: (256, 136), 24: (1, 1), 25: (1, 2), 26: (1, 4), 27: (1, 8), 28: (1, 8),
+    29: (256, 56), 30: (1, 2), 34: (256, 54), 35: (256, 66)
+}
+
+def read_exact(f, size: int) -> bytes:
+    """读取指定字节数，文件提前结束时抛出异常"""
+    data = f.read(size)
+    if len(data) < size:
+        raise ValueError("文件提前结束")
+    return data
+
+def read_uint(f, fmt: str) -> int:
+    return struct.unpack(fmt, read_exact(f, struct.calcsize(fmt)))[0]
+
+def read_gguf_string(f) -> bytes:
+    return read_exact(f, read_uint(f, "<Q"))
+
+def skip_gguf_value(f, value_type: int):
+    """跳过一个元数据值"""
+    if value_type in GGUF_VALUE_SIZES:
+        read_exact(f, GGUF_VALUE_SIZES[value_type])
+    elif value_type == GGUF_TYPE_STRING:
+        read_gguf_string(f)
+    elif value_type == GGUF_TYPE_ARRAY:
+        item_type = read_uint(f, "<I")
+        count = read_uint(f, "<Q")
+        if item_type in GGUF_VALUE_SIZES:
+            read_exact(f, GGUF_VALUE_SIZES[item_type] * count)
+        else:
+            for _ in range(count):
+                skip_gguf_value(f, item_type)
+    else:
+        raise ValueError(f"未知的元数据类型: {value_type}")
+
+def read_gguf_data_end(f, tensor_count: int, kv_count: int) -> Optional[int]:
+    """解析元数据和张量信息，返回张量数据的结束位置；含未知张量类型时返回None"""
+    alignment = GGUF_DEFAULT_ALIGNMENT
+    for _ in range(kv_count):
+        key = read_gguf_string(f)
+        value_type = read_uint(f, "<I")
+        if key == b"general.alignment" and value_type == 4:
+            alignment = read_uint(f, "<I")
+        else:
+            skip_gguf_value(f, value_type)
+    
+    tensors_end = 0
+    known_types = True
+    for _ in range(tensor_count):
+        read_gguf_string(f)
+        n_dims = read_uint(f, "<I")
+        elements = 1
+        for _ in range(n_dims):
+            elements *= read_uint(f, "<Q")
+        tensor_type = read_uint(f, "<I")
+        offset = read_uint(f, "<Q")
+        if tensor_type not in GGML_TYPE_SIZES:
+            known_types = False
+            continue
+        block_elements, block_bytes = GGML_TYPE_SIZES[tensor_type]
+        tensors_end = max(tensors_end, offset + elements // block_elements * block_bytes)
+    
+    # 张量数据从张量信息之后按对齐边界开始
+    data_start = -(-f.tell() // alignment) * alignment
+    return data_start + tensors_end if known_types else None
+
+def check_gguf_header(model_path: str) -> Tuple[bool, str]:
+    """检查GGUF文件头是否合法，并根据张量信息检查文件是否被截断"""
+    try:
+        with open(model_path, 'rb', buffering=1024**2) as f:
+            header = f.read(GGUF_HEADER.size)
+            if len(header) < GGUF_HEADER.size:
+                return False, "文件过小，缺少GGUF文件头"
+            
+            magic, version, tensor_count, kv_count = GGUF_HEADER.unpack(header)
+            if magic != GGUF_MAGIC:
+                return False, f"魔数错误: {magic!r}"
+            if version not in GGUF_VERSIONS:
+                return False, f"不支持的GGUF版本: {version}"
+            if tensor_count == 0 or tensor_count > GGUF_MAX_COUNT or kv_count > GGUF_MAX_COUNT:
+                return False, f"文件头数值异常: 张量数 {tensor_count}, 元数据数 {kv_count}"
+            
+            # GGUF v1使用32位长度字段，只做文件头检查
+            if version == 1:
+                return True, f"GGUF v{version}, {tensor_count} 个张量"
+            
+            try:
+                data_end = read_gguf_data_end(f, tensor_count, kv_count)
+            except (ValueError, struct.error) as e:
+                return False, f"元数据解析失败，文件可能不完整: {e}"
+            file_size = os.fstat(f.fileno()).st_size
+    except OSError as e:
+        return False, f"无法读取文件: {e}"
+    
+    if data_end is None:
+        return True, f"GGUF v{version}, {tensor_count} 个张量, 含未知张量类型，跳过大小检查"
+    if file_size < data_end:
+        return False, f"文件被截断: 应至少 {data_end} 字节，实际 {file_size} 字节"
+    return True, f"GGUF v{version}, {tensor_count} 个张量, 大小检查通过"
+
+def hash_file(model_path: str, chunk_size: int) -> str:
+    """使用内存映射分块计算文件的SHA256"""
+    sha256 = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return sha256.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            # hashlib在处理大块数据时会释放GIL，多个文件可以并行计算
+            with memoryview(mm) as view:
+                for offset in range(0, size, chunk_size):
+                    sha256.update(view[offset:offset + chunk_size])
+    return sha256.hexdigest()
+
+def fetch_upstream_checksum(model_id: str, filename: str) -> Optional[str]:
+    """从Hugging Face获取文件的SHA256（LFS文件的ETag即为SHA256）"""
+    try:
+        from huggingface_hub import get_hf_file_metadata, hf_hub_url
+        metadata = get_hf_file_metadata(hf_hub_url(model_id, filename))
+    except Exception:
+        return None
+    etag = (metadata.etag or "").strip('"').lower()
+    if len(etag) == 64 and all(c in "0123456789abcdef" for c in etag):
+        return etag
+    return None
 
 class ModelManagerCLI:
     def __init__(self):
@@ -152,6 +301,113 @@ class ModelManagerCLI:
         print(f"总占用空间: {total_size/(1024**3):.2f} GB")
         print(f"模型存储目录: {self.models_dir.absolute()}")
     
+    def load_verify_cache(self) -> Dict:
+        """加载校验缓存"""
+        cache_file = VERIFY_CONFIG["cache_file"]
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+    
+    def save_verify_cache(self, cache: Dict):
+        """保存校验缓存"""
+        cache_file = Path(VERIFY_CONFIG["cache_file"])
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+    
+    def verify_models(self, upstream: bool = False, workers: int = None) -> bool:
+        """并行校验所有已注册模型的完整性"""
+        print("\n" + "="*60)
+        print("🔍 模型完整性校验")
+        print("="*60)
+        
+        models = [(model_id, info) for model_id, info in self.model_info.items() if info.get('downloaded', False)]
+        if not models:
+            print("❌ 没有找到已下载的模型")
+            return True
+        
+        cache = self.load_verify_cache()
+        results = {}
+        to_hash = {}
+        
+        for model_id, info in models:
+            model_path = os.path.abspath(info.get('path', ''))
+            if not os.path.exists(model_path):
+                results[model_id] = (False, "文件不存在")
+                continue
+            
+            # 大小和修改时间未变化的文件直接使用缓存的检查结果和哈希
+            stat = os.stat(model_path)
+            cached = cache.get(model_path)
+            if (cached and cached.get('size') == stat.st_size and
+                    cached.get('mtime') == stat.st_mtime_ns and cached.get('header')):
+                results[model_id] = (True, cached['header'])
+                continue
+            
+            header_ok, header_msg = check_gguf_header(model_path)
+            results[model_id] = (header_ok, header_msg)
+            if header_ok:
+                to_hash[model_id] = (model_path, stat)
+        
+        if to_hash:
+            print(f"⏳ 正在计算 {len(to_hash)} 个文件的SHA256...")
+            chunk_size = VERIFY_CONFIG["chunk_mb"] * 1024**2
+            with ThreadPoolExecutor(max_workers=workers or VERIFY_CONFIG["workers"]) as executor:
+                futures = {
+                    model_id: executor.submit(hash_file, model_path, chunk_size)
+                    for model_id, (model_path, _) in to_hash.items()
+                }
+                for model_id, future in futures.items():
+                    model_path, stat = to_hash[model_id]
+                    try:
+                        cache[model_path] = {
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime_ns,
+                            "header": results[model_id][1],
+                            "sha256": future.result()
+                        }
+                    except OSError as e:
+                        results[model_id] = (False, f"读取文件失败: {e}")
+            self.save_verify_cache(cache)
+        
+        config_updated = False
+        all_ok = True
+        for i, (model_id, info) in enumerate(models, 1):
+            ok, detail = results[model_id]
+            model_path = os.path.abspath(info.get('path', ''))
+            digest = cache.get(model_path, {}).get('sha256') if ok else None
+            
+            if ok:
+                expected = info.get('sha256')
+                if not expected and upstream:
+                    expected = fetch_upstream_checksum(model_id, info.get('file', ''))
+                    if expected:
+                        info['sha256'] = expected
+                        config_updated = True
+                if expected and expected != digest:
+                    ok, detail = False, "SHA256不匹配，文件可能已损坏或不完整"
+                elif expected:
+                    detail += ", SHA256校验通过"
+                else:
+                    detail += ", 无参考校验值"
+            
+            all_ok = all_ok and ok
+            status = "✅ 正常" if ok else "❌ 异常"
+            print(f"\n{i}. {model_id}")
+            print(f"   状态: {status}")
+            print(f"   详情: {detail}")
+            if digest:
+                print(f"   SHA256: {digest}")
+        
+        if config_updated:
+            self.save_model_config()
+        
+        return all_ok
+    
     def interactive_menu(self):
         """交互式菜单"""
         while True:
@@ -162,10 +418,11 @@ class ModelManagerCLI:
             print("2. 🗑️  删除指定模型")
             print("3. 🧹 清理缓存")
             print("4. 📊 显示统计信息")
-            print("5. 🚪 退出")
+            print("5. 🔍 校验模型完整性")
+            print("6. 🚪 退出")
             print("="*60)
             
-            choice = input("请选择操作 (1-5): ").strip()
+            choice = input("请选择操作 (1-6): ").strip()
             
             if choice == '1':
                 self.list_models()
@@ -184,6 +441,8 @@ class ModelManagerCLI:
             elif choice == '4':
                 self.show_stats()
             elif choice == '5':
+                self.verify_models()
+            elif choice == '6':
                 print("👋 再见！")
                 break
             else:
@@ -205,6 +464,10 @@ def main():
             manager.clean_cache()
         elif command == 'stats':
             manager.show_stats()
+        elif command == 'verify':
+            upstream = '--upstream' in sys.argv[2:]
+            if not manager.verify_models(upstream=upstream):
+                sys.exit(1)
         elif command == 'delete' and len(sys.argv) > 2:
             model_id = sys.argv[2]
             manager.delete_model(model_id)
@@ -213,6 +476,7 @@ def main():
             print("  python model_manager.py list     - 列出所有模型")
             print("  python model_manager.py clean    - 清理缓存")
             print("  python model_manager.py stats    - 显示统计信息")
+            print("  python model_manager.py verify [--upstream] - 校验模型完整性")
             print("  python model_manager.py delete <model_id> - 删除指定模型")
             print("  python model_manager.py          - 交互式菜单")
     else:
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LocalAI 请求性能分析工具
+对采样的请求进行CPU分析和内存分配跟踪，报告写入 logs/profiles 目录
+"""
+
+import io
+import os
+import sys
+import time
+import pstats
+import random
+import logging
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from config import PROFILE_CONFIG
+
+
+class StackSampler:
+    """定时采样指定线程的调用栈，生成折叠栈（flamegraph格式）"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    """请求级性能分析器"""
+
+    def __init__(self, config: dict = None):
+        self.config = config or PROFILE_CONFIG
+        self.output_dir = Path(self.config["output_dir"])
+        self.logger = logging.getLogger(__name__)
+        # cProfile和tracemalloc都是进程级资源，同一时间只分析一个请求
+        self.lock = threading.Lock()
+
+    def should_profile(self, request=None) -> bool:
+        """判断当前请求是否需要分析"""
+        if self.config["enabled"]:
+            return True
+        headers = getattr(request, "headers", None)
+        if headers and headers.get(self.config["header"]):
+            return True
+        return self.config["sample_rate"] > 0 and random.random() < self.config["sample_rate"]
+
+    @contextmanager
+    def profile(self, label: str):
+        """分析代码块，结束后写出报告；已有请求在分析时直接跳过"""
+        if not self.lock.acquire(blocking=False):
+            yield
+            return
+
+        try:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start(self.config["traceback_depth"])
+            tracemalloc.reset_peak()
+
+            sampler = StackSampler(threading.get_ident(), self.config["sample_interval_ms"] / 1000)
+            profiler = cProfile.Profile()
+            start = time.perf_counter()
+            sampler.start()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                sampler.stop()
+                elapsed = time.perf_counter() - start
+                snapshot = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                if started_tracing:
+                    tracemalloc.stop()
+                # 诊断功能不能影响请求本身，写报告失败只记录日志
+                try:
+                    self.write_reports(label, elapsed, profiler, sampler, snapshot, current, peak)
+                except Exception as e:
+                    self.logger.error(f"写入性能分析报告失败: {e}")
+                try:
+                    self.rotate()
+                except Exception as e:
+                    self.logger.error(f"清理性能分析报告失败: {e}")
+        finally:
+            self.lock.release()
+
+    def write_reports(self, label, elapsed, profiler, sampler, snapshot, current, peak):
+        """写出折叠栈、函数耗时和内存分配报告"""
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        prefix = self.output_dir / f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{label}"
+
+        with open(f"{prefix}.folded", 'w', encoding='utf-8') as f:
+            f.write(sampler.collapsed())
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(self.config["top_functions"])
+        with open(f"{prefix}.cpu.txt", 'w', encoding='utf-8') as f:
+            f.write(f"请求: {label}\n耗时: {elapsed*1000:.1f} ms\n\n")
+            f.write(stream.getvalue())
+
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)
+        ])
+        with open(f"{prefix}.alloc.txt", 'w', encoding='utf-8') as f:
+            f.write(f"当前内存: {current/1024:.1f} KB\n峰值内存: {peak/1024:.1f} KB\n\n")
+            for stat in snapshot.statistics("traceback")[:self.config["top_allocations"]]:
+                f.write(f"{stat.size/1024:.1f} KB, {stat.count} 块\n")
+                for line in stat.traceback.format():
+                    f.write(f"{line}\n")
+                f.write("\n")
+
+    def rotate(self):
+        """按请求数量和总大小上限删除最旧的报告，同一请求的报告文件一起删除"""
+        if not self.output_dir.is_dir():
+            return
+        reports = {}
+        for path in self.output_dir.iterdir():
+            if path.is_file():
+                # 报告文件名为 <时间戳>_<标签>.<类型>，前缀相同的属于同一请求
+                reports.setdefault(path.name.split(".", 1)[0], []).append(path)
+
+        # 前缀以时间戳开头，按名称排序即按时间排序
+        prefixes = sorted(reports)
+        max_bytes = self.config["max_total_mb"] * 1024**2
+        total = sum(p.stat().st_size for paths in reports.values() for p in paths)
+        while prefixes and (len(prefixes) > self.config["max_reports"] or total > max_bytes):
+            for path in reports[prefixes.pop(0)]:
+                try:
+                    total -= path.stat().st_size
+                    path.unlink()
+                except OSError:
+                    pass
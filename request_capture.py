@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LocalAI 请求形状采集
+记录匿名化的请求形状，供 loadtest.py 回放
+"""
+
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Optional
+from config import CAPTURE_CONFIG
+
+
+class RequestCapture:
+    """请求形状采集器，只记录长度和时间信息，不记录对话内容"""
+
+    def __init__(self, capture_file: str = None, max_records: int = None):
+        self.capture_file = Path(capture_file or CAPTURE_CONFIG["capture_file"])
+        self.capture_file.parent.mkdir(parents=True, exist_ok=True)
+        self.max_records = max_records or CAPTURE_CONFIG["max_records"]
+        self.lock = threading.Lock()
+        self.last_arrival: Optional[float] = None
+        self.records = self.count_records()
+
+    def count_records(self) -> int:
+        """统计采集文件中已有的记录数"""
+        if not self.capture_file.exists():
+            return 0
+        with open(self.capture_file, 'r', encoding='utf-8') as f:
+            return sum(1 for _ in f)
+
+    def record(self, prompt_tokens: int, message_tokens: int, history_depth: int, max_tokens: int):
+        """记录一次请求的形状"""
+        with self.lock:
+            if self.records >= self.max_records:
+                return
+            now = time.time()
+            interarrival = 0.0 if self.last_arrival is None else now - self.last_arrival
+            self.last_arrival = now
+            entry = {
+                "dt": round(interarrival, 3),
+                "pt": prompt_tokens,
+                "mt": message_tokens,
+                "hd": history_depth,
+                "mx": max_tokens
+            }
+            with open(self.capture_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+            self.records += 1